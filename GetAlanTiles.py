@@ -1,10 +1,15 @@
 #!/usr/bin/env python3
-'''Calculate ALAN for regions and months of interest and save to NetCDF.'''
+'''Calculate ALAN for regions and months of interest, save to NetCDF/Zarr.'''
 import argparse
+import os
 import sys
 import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
 
-from alan_tools.alan_tile import ALANTile
+from alan_tools.alan_tile import ALANRegion, ALANTile, save_tiles_to_zarr
+from alan_tools._kernels import set_num_threads
 import alan_tools.config as cfg
 
 REGION_LOOKUP = {
@@ -47,43 +52,136 @@ MONTHS_LIST = [
 ]
 
 
-parser = argparse.ArgumentParser()
-parser.add_argument('output_dir',
-                    help='Directory where ALAN outputs will be saved.')
-parser.add_argument('--regions', nargs='+', type=str,
-                    default=REGION_LOOKUP.keys(),
-                    help='List of regions to be processed. Choose from '
-                         f'{list(REGION_LOOKUP.keys())}')
-parser.add_argument('--months', nargs='+', type=str,
-                    default=MONTHS_LIST,
-                    help='List of months to be processed. Choose from '
-                         f'{MONTHS_LIST}')
-parser.add_argument('--kd_dir', default=cfg.KD_DIR,
-                    help='Directory containing Kd files.')
-parser.add_argument('--kd_fpattern', default=cfg.KD_FPATTERN,
-                    help='File pattern for Kd files.')
-parser.add_argument('--falchi_path', default=cfg.FALCHI_PATH,
-                    help='Full path to Falchi data.')
-parser.add_argument('--landmask_path', default=cfg.LANDMASK_PATH,
-                    help='Full path to landmask file.')
-parser.add_argument('--loglevel', default='DEBUG')
-args = parser.parse_args()
-logging.basicConfig(level=getattr(logging, args.loglevel.upper()),
-                    stream=sys.stdout)
+def available_cpus():
+    '''
+    Number of CPUs this process may run on, which can be fewer than the
+    machine has (e.g. under SLURM, cpusets or taskset).
 
-logging.debug(f'Regions to be processed: {args.regions}')
-logging.debug(f'Months to be processed: {args.months}')
+    '''
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count()
 
-for region_name in args.regions:
+
+def init_worker(loglevel, num_threads):
+    '''
+    Set up logging and limit threads in each worker process, so that the
+    parallel kernels in the workers don't oversubscribe the CPUs.
+
+    '''
+    set_num_threads(num_threads)
+    logging.basicConfig(level=getattr(logging, loglevel.upper()),
+                        stream=sys.stdout)
+
+
+def process_region(region_name, args):
+    '''
+    Calculate and save ALAN for all requested months of a region. Run in a
+    worker process; the region data is loaded once and reused per month.
+
+    '''
     logging.debug(f'Processing {region_name}')
     roi = REGION_LOOKUP[region_name]['region']
     user_friendly_region_name = REGION_LOOKUP[region_name]['name']
-    for month in args.months:
-        logging.debug(f'Processing month {month}')
-        alan_tile = ALANTile(
-            user_friendly_region_name, roi, month, kd_dir=args.kd_dir,
-            kd_fpattern=args.kd_fpattern, falchi_path=args.falchi_path,
-            landmask_path=args.landmask_path)
-        logging.debug(f'Saving results to {args.output_dir}')
-        alan_tile.save_z_thresh_to_nc(
-            output_dir=args.output_dir, region_name=region_name)
+    # Landmask and Falchi data are month-invariant so only load once.
+    alan_region = ALANRegion(
+        user_friendly_region_name, roi, falchi_path=args.falchi_path,
+        landmask_path=args.landmask_path)
+    if args.batch_months:
+        # All months in one kernel call; holds Kd for every month in memory.
+        logging.debug(f'Processing {region_name} months {args.months}')
+        alan_tiles = ALANTile.from_months(
+            alan_region, args.months, kd_dir=args.kd_dir,
+            kd_fpattern=args.kd_fpattern)
+        if args.zarr:
+            logging.debug(f'Saving results to {args.output_dir}')
+            save_tiles_to_zarr(
+                alan_tiles, output_dir=args.output_dir,
+                region_name=region_name)
+            return region_name
+    else:
+        alan_tiles = (
+            ALANTile(alan_region, month, kd_dir=args.kd_dir,
+                     kd_fpattern=args.kd_fpattern)
+            for month in args.months)
+    # Write each month in a background thread while the next month is read
+    # and calculated. Only one write is kept in flight so finished tiles
+    # don't pile up in memory if writing is slower than calculating.
+    pending_write = None
+    with ThreadPoolExecutor(max_workers=1) as writer_pool:
+        for alan_tile in alan_tiles:
+            if pending_write is not None:
+                pending_write.result()
+            logging.debug(f'Saving {region_name} month {alan_tile.month} '
+                          f'results to {args.output_dir}')
+            if args.zarr:
+                # The first month overwrites any store left by an earlier
+                # run, later months append to it.
+                save = partial(alan_tile.save_z_thresh_to_zarr,
+                               append=pending_write is not None)
+            else:
+                save = alan_tile.save_z_thresh_to_nc
+            pending_write = writer_pool.submit(
+                save, output_dir=args.output_dir, region_name=region_name)
+        if pending_write is not None:
+            pending_write.result()
+    return region_name
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('output_dir',
+                        help='Directory where ALAN outputs will be saved.')
+    parser.add_argument('--regions', nargs='+', type=str,
+                        default=list(REGION_LOOKUP.keys()),
+                        help='List of regions to be processed. Choose from '
+                             f'{list(REGION_LOOKUP.keys())}')
+    parser.add_argument('--months', nargs='+', type=str,
+                        default=MONTHS_LIST,
+                        help='List of months to be processed. Choose from '
+                             f'{MONTHS_LIST}')
+    parser.add_argument('--kd_dir', default=cfg.KD_DIR,
+                        help='Directory containing Kd files.')
+    parser.add_argument('--kd_fpattern', default=cfg.KD_FPATTERN,
+                        help='File pattern for Kd files.')
+    parser.add_argument('--falchi_path', default=cfg.FALCHI_PATH,
+                        help='Full path to Falchi data.')
+    parser.add_argument('--landmask_path', default=cfg.LANDMASK_PATH,
+                        help='Full path to landmask file.')
+    parser.add_argument('--zarr', action='store_true',
+                        help='Save each region to a single Zarr store, '
+                             'appending months along time, instead of a '
+                             'NetCDF file per month.')
+    parser.add_argument('--batch_months', action='store_true',
+                        help='Calculate all months of a region in a single '
+                             'pass. Faster, but holds the Kd data for all '
+                             'months in memory at once.')
+    parser.add_argument('--workers', type=int, default=available_cpus(),
+                        help='Maximum number of worker processes. Each '
+                             'worker processes all months of one region.')
+    parser.add_argument('--loglevel', default='DEBUG')
+    args = parser.parse_args()
+    logging.basicConfig(level=getattr(logging, args.loglevel.upper()),
+                        stream=sys.stdout)
+
+    logging.debug(f'Regions to be processed: {args.regions}')
+    logging.debug(f'Months to be processed: {args.months}')
+
+    # Regions are independent, so process them in parallel. Months within a
+    # region are kept in one worker to share the region data. Workers are
+    # spawned rather than forked, as forking after the numba/HDF5 libraries
+    # have been loaded can deadlock.
+    n_workers = max(1, min(args.workers, len(args.regions)))
+    threads_per_worker = max(1, available_cpus() // n_workers)
+    # Set before the pool starts so the workers inherit it; numpy reads it
+    # on import, which happens before init_worker runs.
+    os.environ['OMP_NUM_THREADS'] = str(threads_per_worker)
+    with ProcessPoolExecutor(
+            max_workers=n_workers, initializer=init_worker,
+            mp_context=multiprocessing.get_context('spawn'),
+            initargs=(args.loglevel, threads_per_worker)) as executor:
+        futures = [executor.submit(process_region, region_name, args)
+                   for region_name in args.regions]
+        for future in futures:
+            logging.debug(f'Finished {future.result()}')
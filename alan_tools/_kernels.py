@@ -0,0 +1,141 @@
+'''
+Kernels for the per-pixel parts of the ALAN calculations.
+
+Numba is used if installed. Otherwise the same calculation falls back to
+numexpr, which still evaluates each expression in a single blocked,
+multi-threaded pass without full-grid temporaries between operations.
+
+'''
+import math
+
+import numpy as np
+
+try:
+    import numba
+    from numba import njit, prange
+except ImportError:
+    numba = None
+    import numexpr
+
+
+if numba is not None:
+    # fastmath without the 'nnan'/'ninf' flags, which would let LLVM optimise
+    # away the NaN checks the kernel relies on for masking.
+    FASTMATH_FLAGS = {'nsz', 'arcp', 'contract', 'afn', 'reassoc'}
+
+    # Explicit float32 signature so the transcendentals use packed single
+    # precision paths. Declaring it also compiles the kernel at import (or
+    # loads it from the on-disk cache), so there is no dispatch or JIT
+    # latency on the first call in each worker process.
+    Z_THRESH_SIGNATURE = \
+        'void(f4[::1], f4[:, :, ::1], f4[:, ::1], ' \
+        'f4, f4, f4, f4, f4, f4, f4, f4)'
+
+    # The 'numpy' error model drops the zero-division checks (st is always
+    # positive and kt is checked), which would otherwise block vectorising.
+    @njit(Z_THRESH_SIGNATURE, parallel=True, fastmath=FASTMATH_FLAGS,
+          cache=True, boundscheck=False, error_model='numpy')
+    def _z_thresh_kernel(falchi, kd, out, M_B, C_B, M_G, C_G, M_R, C_R,
+                         thresh_mask, thresh_irr):
+        '''
+        Calculate the critical depth for each pixel and month in a single
+        pass, writing the result into out. Pixels that can't be calculated
+        are set to NaN.
+
+        Args:
+
+        falchi (numpy.array):
+            Flattened float32 Falchi data on the target grid.
+        kd (numpy.array):
+            Float32 Kd data on the target grid, shape (month, channel, pixel)
+            with channels ordered blue, green, red.
+        out (numpy.array):
+            Float32 output array for z_thresh, shape (month, pixel).
+        M_B, C_B, M_G, C_G, M_R, C_R (float):
+            Coefficients converting Falchi to surface irradiance per channel.
+        thresh_mask (float): Falchi values at or below this are masked.
+        thresh_irr (float): Irradiance threshold used to define z_thresh.
+
+        '''
+        n_pixels = falchi.size
+        for i in prange(kd.shape[0] * n_pixels):
+            t = i // n_pixels
+            p = i - t * n_pixels
+            f = falchi[p]
+            if f != f or f <= thresh_mask:
+                out[t, p] = math.nan
+                continue
+
+            # Above water irradiance in the blue, green and red (uW/m2).
+            sb = M_B * f + C_B
+            sg = M_G * f + C_G
+            sr = M_R * f + C_R
+            st = sb + sg + sr
+
+            k = (sb / st) * math.exp(-kd[t, 0, p]) + \
+                (sg / st) * math.exp(-kd[t, 1, p]) + \
+                (sr / st) * math.exp(-kd[t, 2, p])
+            if k != k or k <= 0.:
+                out[t, p] = math.nan
+                continue
+
+            kt = -math.log(k)
+            if kt <= 0.:
+                out[t, p] = math.nan
+                continue
+
+            out[t, p] = -math.log(thresh_irr / st) / kt
+
+else:
+    def _z_thresh_kernel(falchi, kd, out, M_B, C_B, M_G, C_G, M_R, C_R,
+                         thresh_mask, thresh_irr):
+        '''
+        numexpr version of the z_thresh kernel, with the same arguments.
+
+        '''
+        # Scalars as float32 so numexpr doesn't upcast the arrays to float64.
+        local_dict = {
+            name: np.float32(value) for name, value in (
+                ('M_B', M_B), ('C_B', C_B), ('M_G', M_G), ('C_G', C_G),
+                ('M_R', M_R), ('C_R', C_R), ('thresh_mask', thresh_mask),
+                ('thresh_irr', thresh_irr), ('nan', np.nan))}
+        # Falchi (pixel) broadcasts against Kd (month, pixel).
+        local_dict.update(
+            f=falchi, kd_b=kd[:, 0], kd_g=kd[:, 1], kd_r=kd[:, 2])
+
+        # Above water irradiance in the blue, green and red (uW/m2).
+        local_dict['st'] = numexpr.evaluate(
+            '(M_B * f + C_B) + (M_G * f + C_G) + (M_R * f + C_R)',
+            local_dict=local_dict)
+        local_dict['k'] = numexpr.evaluate(
+            '((M_B * f + C_B) * exp(-kd_b) + (M_G * f + C_G) * exp(-kd_g)'
+            ' + (M_R * f + C_R) * exp(-kd_r)) / st',
+            local_dict=local_dict)
+        # Only take the log where it is defined, leaving NaN elsewhere.
+        k = local_dict['k']
+        kt = np.full_like(k, np.nan)
+        np.log(k, out=kt, where=k > 0.)
+        np.negative(kt, out=kt)
+        local_dict['kt'] = kt
+        numexpr.evaluate(
+            'where((f > thresh_mask) & (kt > 0),'
+            ' -log(thresh_irr / st) / kt, nan)',
+            local_dict=local_dict, out=out)
+
+
+def set_num_threads(num_threads):
+    '''
+    Set the number of threads used by the kernels in this process.
+
+    Args:
+
+    num_threads (int):
+        Number of threads. Clamped to the size of numba's thread pool, which
+        is limited by the CPU affinity of the process or NUMBA_NUM_THREADS.
+
+    '''
+    if numba is not None:
+        numba.set_num_threads(
+            min(num_threads, numba.config.NUMBA_NUM_THREADS))
+    else:
+        numexpr.set_num_threads(num_threads)
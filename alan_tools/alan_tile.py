@@ -5,67 +5,245 @@ the sea data.
 '''
 from pathlib import Path
 from datetime import datetime
-import copy
+import functools
 
+import hdf5plugin
+import numcodecs
 import numpy as np
 import xarray as xr
-import pyinterp.backends.xarray
-import pyinterp.fill
+import rioxarray
+import scipy.ndimage
 
 import alan_tools.config as cfg
 import alan_tools.file_attributes as attrs
+from alan_tools._kernels import _z_thresh_kernel
 
 
-def fill_and_regrid(in_arr, mx, my):
+@functools.lru_cache(maxsize=4)
+def open_falchi(falchi_path):
     '''
-    Use pyinterp module to fill in some of the NaNs at the coast and to
-    interpolate data to target grid.
+    Lazily open the Falchi GeoTIFF. Cached so that repeated tiles reuse the
+    same open handle; pixels are only read once a window is selected.
+
+    Args:
+
+    falchi_path (str): Full path to Falchi data.
+
+    '''
+    return rioxarray.open_rasterio(
+        falchi_path, masked=True, chunks={'x': 2048, 'y': 2048})
+
+
+@functools.lru_cache(maxsize=4)
+def open_landmask(landmask_path):
+    '''
+    Lazily open the landmask Zarr store. Cached so that the store metadata
+    is only read once per process.
+
+    Args:
+
+    landmask_path (str): Full path to landmask file.
+
+    '''
+    return xr.open_zarr(landmask_path)
+
+
+def axis_weights(src_coord, target_coord):
+    '''
+    Find the 1D linear interpolation indices and weights for target coords
+    on a regular source axis. Targets outside the source axis are clamped to
+    the edge values.
+
+    Args:
+
+    src_coord (numpy.array): Regular 1D source coordinates.
+    target_coord (numpy.array): 1D target coordinates.
+
+    Returns:
+
+    (lower, upper, weight): Tuple of numpy.arrays, with the indices of the
+        source points either side of each target and the weight of the upper
+        point. Where a target falls on a source point, upper is the same as
+        lower so NaNs in the unused neighbour aren't picked up.
+
+    '''
+    pos = (target_coord - src_coord[0]) / (src_coord[1] - src_coord[0])
+    pos = np.clip(pos, 0, src_coord.size - 1)
+    # Snap targets that are on a source point apart from coordinate rounding
+    # noise, so they get a float32 weight of exactly 0 rather than ~0 or ~1.
+    nearest = np.round(pos)
+    pos = np.where(np.isclose(pos, nearest, rtol=0, atol=1e-6), nearest, pos)
+    lower = pos.astype(np.intp)
+    weight = (pos - lower).astype(np.float32)
+    upper = np.where(weight > 0, lower + 1, lower)
+    return lower, upper, weight
+
+
+def regrid_weights(in_arr, target_lat, target_lon):
+    '''
+    Precompute bilinear interpolation weights from the in_arr grid to the
+    target grid. Both grids are regular, so bilinear interpolation separates
+    into 1D interpolations along lat and lon.
 
     Args:
 
     in_arr (xarray.DataArray): Input array to move to target grid.
-    mx (numpy.array): Array of target longitudes.
-    my (numpy.array): Array of target latitudes.
+    target_lat (numpy.array): 1D array of target latitudes.
+    target_lon (numpy.array): 1D array of target longitudes.
 
     Returns:
 
-    regridded.T: numpy.array containing regridded input.
+    (lat_weights, lon_weights): Tuple of axis_weights outputs.
 
     '''
-    grid = pyinterp.backends.xarray.Grid2D(in_arr)
-    filled = pyinterp.fill.loess(grid, nx=3, ny=3)
-    # pyinterp.fill returns a numpy array so put back in DataArray.
-    # Also need to transpose data.
-    filled_ds = in_arr.copy()
-    filled_ds.data = filled.T
+    return (axis_weights(in_arr.lat.values, target_lat),
+            axis_weights(in_arr.lon.values, target_lon))
+
 
-    interpolator = pyinterp.backends.xarray.Grid2D(filled_ds)
-    regridded = interpolator.bivariate(
-        coords=dict(lon=mx.ravel(), lat=my.ravel())).reshape(mx.shape)
+def coastal_fill_indices(invalid, radius=3):
+    '''
+    Find the nearest valid pixel for each invalid pixel within radius pixels
+    of valid data, used to fill in some of the NaNs at the coast. Only
+    depends on where the NaNs are, so can be reused for any data with the
+    same NaN pattern.
 
-    return regridded.T
+    Args:
 
+    invalid (numpy.array): Boolean array, True where data is missing.
+    radius (float): Maximum distance (in pixels) to fill from valid data.
+
+    Returns:
+
+    (dst, src): Tuple of flat indices of the pixels to fill and of the
+        valid pixels to fill them from.
 
-class ALANTile:
     '''
-    Class for creating objects containing data used for calculating ALAN
-    tiles, with methods for calculating, saving and plotting the critical
-    depth (z_thresh) output.
+    if invalid.all() or not invalid.any():
+        empty = np.empty(0, dtype=np.intp)
+        return empty, empty
+    # Only pixels within radius of the missing data are involved, so run the
+    # EDT on a padded bounding box around it rather than the whole array.
+    pad = int(np.ceil(radius))
+    rows = np.flatnonzero(invalid.any(axis=1))
+    cols = np.flatnonzero(invalid.any(axis=0))
+    row0, col0 = max(rows[0] - pad, 0), max(cols[0] - pad, 0)
+    box = invalid[row0:rows[-1] + pad + 1, col0:cols[-1] + pad + 1]
+    dist, (ii, jj) = scipy.ndimage.distance_transform_edt(
+        box, return_indices=True)
+    fill_i, fill_j = np.nonzero(box & (dist <= radius))
+    dst = np.ravel_multi_index((fill_i + row0, fill_j + col0), invalid.shape)
+    src = np.ravel_multi_index(
+        (ii[fill_i, fill_j] + row0, jj[fill_i, fill_j] + col0),
+        invalid.shape)
+    return dst, src
+
+
+def fill_and_regrid(in_arr, weights, fill_indices):
+    '''
+    Fill in some of the NaNs at the coast from the nearest valid pixel, then
+    bilinearly interpolate data to target grid.
+
+    Args:
+
+    in_arr (numpy.array): Input (lat, lon) array to move to target grid.
+    weights (tuple): Interpolation weights from regrid_weights.
+    fill_indices (tuple):
+        (dst, src) indices from coastal_fill_indices for in_arr.
+
+    Returns:
+
+    regridded: numpy.array (lat, lon) containing regridded input.
+
+    '''
+    dst, src = fill_indices
+    filled = np.array(in_arr, order='C')
+    filled.reshape(-1)[dst] = filled.reshape(-1)[src]
+
+    (lat0, lat1, lat_w), (lon0, lon1, lon_w) = weights
+    lat_w = lat_w[:, np.newaxis]
+    rows = filled[lat0] * (1 - lat_w) + filled[lat1] * lat_w
+    regridded = rows[:, lon0] * (1 - lon_w) + rows[:, lon1] * lon_w
+
+    return regridded
+
+
+def write_z_thresh_to_zarr(z_thresh_ds, store_path, append=False):
+    '''
+    Write a z_thresh dataset to a Zarr store.
+
+    Args:
+
+    z_thresh_ds (xarray.Dataset): Dataset from make_z_thresh_dataset.
+    store_path (pathlib.Path): Path to the Zarr store.
+    append (bool):
+        Append along the time dimension of an existing store. Otherwise the
+        store is created, overwriting any existing store at store_path.
+
+    '''
+    if append:
+        # Encoding (including _FillValue) is fixed when the store is
+        # created, and xarray refuses to append if it is also in attrs.
+        z_thresh_ds['z_thresh'].attrs.pop('_FillValue', None)
+        z_thresh_ds.to_zarr(store_path, mode='a', append_dim='time')
+    else:
+        # Chunk to one month and a spatial tile, the typical access
+        # pattern for analysis.
+        encoding = {
+            'z_thresh': {
+                'compressor': numcodecs.Blosc(
+                    cname='zstd', clevel=3,
+                    shuffle=numcodecs.Blosc.BITSHUFFLE),
+                'chunks': (1, 512, 512)},
+            'lat': {'_FillValue': None},
+            'lon': {'_FillValue': None}
+        }
+        z_thresh_ds.to_zarr(store_path, mode='w', encoding=encoding)
+
+
+def save_tiles_to_zarr(
+        tiles, output_dir='./', output_store=None, region_name=None):
+    '''
+    Save the critical depth output of several tiles (e.g. from
+    ALANTile.from_months) of the same region to a Zarr store in a single
+    write. The write covers the whole region, so any existing store is
+    overwritten.
+
+    Args:
+
+    tiles (list): ALANTile objects for the same region.
+    output_dir (str):
+        Optionally provide path to output dir (default current dir).
+    output_store (str): Optionally override the default store name.
+    region_name (str):
+        If using default store name can optionally add the region name to
+        end of store name.
+
+    '''
+    store_name = \
+        output_store or tiles[0].make_output_store_name(region_name)
+    z_thresh_ds = xr.concat(
+        [tile.make_z_thresh_dataset() for tile in tiles], dim='time',
+        data_vars='minimal', coords='minimal', compat='override')
+    write_z_thresh_to_zarr(z_thresh_ds, Path(output_dir) / store_name)
+    return z_thresh_ds
+
+
+class ALANRegion:
+    '''
+    Class for creating objects containing the month-invariant data used for
+    calculating ALAN tiles over a region: the landmask (which also defines
+    the target grid) and the Falchi data.
 
     '''
 
     def __init__(
-            self, region_name, roi, month, kd_dir=cfg.KD_DIR,
-            kd_fpattern=cfg.KD_FPATTERN, falchi_path=cfg.FALCHI_PATH,
+            self, region_name, roi, falchi_path=cfg.FALCHI_PATH,
             landmask_path=cfg.LANDMASK_PATH):
         '''
         Args:
 
         region_name (str): Name for the region of interest
         roi (tuple): Coordinates for the region of interest (S, N, W, E).
-        month (str): Month used for Kd input.
-        kd_dir (str): Optionally override directory containing Kd files.
-        kd_fpattern (str): Optionally override file pattern for Kd files.
         falchi_path (str): Optionally override full path to Falchi data.
         landmask_path (str): Optionally override full path to landmask file.
 
@@ -73,47 +251,103 @@ class ALANTile:
         self.region_name = region_name
         self.roi = roi
         self.min_lat, self.max_lat, self.min_lon, self.max_lon = self.roi
-        self.month = month
 
-        self.kd_path = Path(kd_dir) / kd_fpattern.format(month=month)
         self.falchi_path = falchi_path
         self.landmask_path = landmask_path
 
+        # Fill in the region placeholders of the global attributes once;
+        # only the creation date changes per tile.
+        spatial_extent = f'Latitude: [{self.min_lat},{self.max_lat}] ' \
+                         f'Longitude: [{self.min_lon},{self.max_lon}]'
+        self.global_attributes = {
+            **attrs.global_attributes,
+            'title': attrs.global_attributes['title'].replace(
+                'REGION_PLACEHOLDER', self.region_name),
+            'extents': attrs.global_attributes['extents'].replace(
+                'SPATIAL_PLACEHOLDER', spatial_extent),
+            'abstract': attrs.global_attributes['abstract'].replace(
+                'SPATIAL_PLACEHOLDER', spatial_extent),
+        }
+
         # Read in and transform the input data.
         self.landmask_data = self.get_landmask_data()
+        # Pre-inverted so that True marks land pixels.
+        self._land_bool = self.landmask_data.landmask.values != 255
         self.target_grid = self.landmask_data
         self.lat, self.lon = self.target_grid.lat, self.target_grid.lon
+        # Regrid weights keyed by source grid, shared by all tiles.
+        self._weights_cache = {}
+        # Most recent Kd NaN pattern and its coastal fill indices.
+        self._kd_fill_cache = None
 
         self.falchi_data = self.get_falchi_data()
+        self.falchi_weights = self.get_regrid_weights(self.falchi_data)
         self.falchi_regridded = self.regrid_falchi()
         self.falchi_masked = self.mask_falchi()
 
-        self.kd_data = self.get_kd_data()
-        self.kd_regridded = self.regrid_kd()
+    def get_regrid_weights(self, in_arr):
+        '''
+        Return the regrid weights for in_arr (see regrid_weights). The
+        weights only depend on the source grid, so they are cached and
+        reused, e.g. for the Kd data of every month.
 
-        # Calculate critical depth (z_thresh).
-        self.z_thresh = self.calculate_z_thresh()
+        Args:
+
+        in_arr (xarray.DataArray or xarray.Dataset): Data on source grid.
+
+        '''
+        key = tuple(float(v) for v in (*in_arr.lat.values[:2],
+                                       *in_arr.lon.values[:2])) + \
+            (in_arr.lat.size, in_arr.lon.size)
+        if key not in self._weights_cache:
+            self._weights_cache[key] = regrid_weights(
+                in_arr, self.lat.data, self.lon.data)
+        return self._weights_cache[key]
+
+    def get_kd_fill_indices(self, kd_arr):
+        '''
+        Return coastal fill indices (see coastal_fill_indices) for a Kd
+        channel. The Kd NaNs are mostly land so the pattern rarely changes
+        between channels and months; the indices are reused while it stays
+        the same.
+
+        Args:
+
+        kd_arr (numpy.array): Kd channel data on the Kd grid.
+
+        '''
+        invalid = np.isnan(kd_arr)
+        if self._kd_fill_cache is None or \
+                not np.array_equal(self._kd_fill_cache[0], invalid):
+            self._kd_fill_cache = (invalid, coastal_fill_indices(invalid))
+        return self._kd_fill_cache[1]
 
     def get_landmask_data(self):
-        '''Read in the landmask and extract ROI.'''
-        landmask = xr.open_zarr(self.landmask_path)
+        '''
+        Read in the landmask and extract ROI. The landmask is loaded into
+        memory as uint8, so it is only decompressed once.
+
+        '''
+        landmask = open_landmask(self.landmask_path)
         landmask_roi = landmask.sel(
             lat=slice(self.max_lat, self.min_lat),
             lon=slice(self.min_lon, self.max_lon))
+        landmask_roi['landmask'] = \
+            landmask_roi.landmask.astype(np.uint8).compute()
         return landmask_roi
 
     def get_falchi_data(self):
         '''
-        Read in the Falchi data and extract ROI. Add coord attributes required
-        by pyinterp methods.
+        Read in the Falchi data and extract ROI. Add coord attributes.
 
         '''
-        falchi = xr.open_rasterio(self.falchi_path)
+        falchi = open_falchi(self.falchi_path)
         # Read in the Falchi data with 1deg buffer to avoid issues
-        # interpolating to values outside range of Falchi data.
-        falchi_roi = falchi.sel(
-            y=slice(self.max_lat + 1, self.min_lat - 1),
-            x=slice(self.min_lon - 1, self.max_lon + 1))
+        # interpolating to values outside range of Falchi data. Only this
+        # window is read from disk.
+        falchi_roi = falchi.rio.clip_box(
+            minx=self.min_lon - 1, miny=self.min_lat - 1,
+            maxx=self.max_lon + 1, maxy=self.max_lat + 1).compute()
 
         falchi_roi = falchi_roi.rename({'x': 'lon', 'y': 'lat'})
         falchi_roi.lat.attrs = attrs.LAT_META
@@ -127,18 +361,140 @@ class ALANTile:
         some rounding errors in lats/lons so doing for consistency in coords.
 
         '''
-        mx, my = np.meshgrid(
-            self.lon.data, self.lat.data, indexing='ij')
-        regridded = fill_and_regrid(self.falchi_data[0], mx, my)
+        falchi = self.falchi_data[0].values
+        regridded = fill_and_regrid(
+            falchi, self.falchi_weights,
+            coastal_fill_indices(np.isnan(falchi)))
         return regridded
 
     def mask_falchi(self):
-        '''Apply mask for low Falchi data values.'''
-        falchi_masked = np.where(
-            self.falchi_regridded <= cfg.FALCHI_MASK_THRESHOLD,
-            np.nan, self.falchi_regridded)
+        '''Apply mask for low Falchi data values. Returns float32 array.'''
+        falchi_masked = self.falchi_regridded.astype(np.float32)
+        falchi_masked[falchi_masked <= cfg.FALCHI_MASK_THRESHOLD] = np.nan
         return falchi_masked
 
+    def apply_landmask(self, in_arr):
+        '''
+        Apply the landmask to the input array in place and return it.
+        The trailing (lat, lon) dimensions of input need to match landmask
+        data.
+
+        Args:
+
+        in_arr (numpy.array): Array to be masked.
+
+        '''
+        in_arr[..., self._land_bool] = np.nan
+        return in_arr
+
+    def calculate_z_thresh(self, kd_months):
+        '''
+        Calculate the critical depth using Falchi and Kd inputs for one or
+        more months in a single kernel call. Apply landmask to result.
+        Returns array with shape (month, lat, lon).
+
+        Args:
+
+        kd_months (numpy.array):
+            Float32 Kd data on target grid, shape (month, channel, lat, lon)
+            with channels in the order of cfg.KD_CHANNELS.
+
+        '''
+        # The above water irradiance in the blue, green and red is calculated
+        # per pixel in the kernel. Falchi units are in mCd/m2. Irradiance is
+        # in uW/m2. Calculation with offset added (7/3/21). This
+        # corroborated by working with the Tamir data in Eilat.
+        n_months = kd_months.shape[0]
+        z_thresh = np.empty(
+            (n_months, *self.falchi_masked.shape), dtype=np.float32)
+        _z_thresh_kernel(
+            self.falchi_masked.ravel(),
+            kd_months.reshape(n_months, len(cfg.KD_CHANNELS), -1),
+            z_thresh.reshape(n_months, -1),
+            cfg.M_BLUE, cfg.C_BLUE, cfg.M_GREEN, cfg.C_GREEN,
+            cfg.M_RED, cfg.C_RED,
+            cfg.FALCHI_MASK_THRESHOLD, cfg.THRESH_IRR_TOTAL_UW_M2)
+
+        z_thresh = self.apply_landmask(z_thresh)
+        return z_thresh
+
+
+class ALANTile:
+    '''
+    Class for creating objects containing data used for calculating ALAN
+    tiles, with methods for calculating, saving and plotting the critical
+    depth (z_thresh) output.
+
+    '''
+
+    def __init__(
+            self, region, month, kd_dir=cfg.KD_DIR,
+            kd_fpattern=cfg.KD_FPATTERN, calculate=True):
+        '''
+        Args:
+
+        region (ALANRegion): Region data (landmask, Falchi) for the tile.
+        month (str): Month used for Kd input.
+        kd_dir (str): Optionally override directory containing Kd files.
+        kd_fpattern (str): Optionally override file pattern for Kd files.
+        calculate (bool):
+            If False, only read and regrid the Kd data and leave z_thresh
+            unset (used by from_months).
+
+        '''
+        self.region = region
+        self.region_name = region.region_name
+        self.roi = region.roi
+        self.min_lat, self.max_lat, self.min_lon, self.max_lon = self.roi
+        self.lat, self.lon = region.lat, region.lon
+        self.month = month
+
+        self.kd_path = Path(kd_dir) / kd_fpattern.format(month=month)
+
+        # Read in and transform the input data.
+        self.kd_data = self.get_kd_data()
+        self.kd_stack = self.regrid_kd()
+
+        # Calculate critical depth (z_thresh).
+        if calculate:
+            self.z_thresh = self.calculate_z_thresh()
+
+    @classmethod
+    def from_months(
+            cls, region, months, kd_dir=cfg.KD_DIR,
+            kd_fpattern=cfg.KD_FPATTERN):
+        '''
+        Create tiles for several months of a region, calculating z_thresh for
+        all months in a single kernel call. Faster than creating the tiles
+        one at a time, but holds the regridded Kd data for all months in
+        memory at once. Returns list of ALANTile.
+
+        Args:
+
+        region (ALANRegion): Region data (landmask, Falchi) for the tiles.
+        months (list): Months used for Kd input.
+        kd_dir (str): Optionally override directory containing Kd files.
+        kd_fpattern (str): Optionally override file pattern for Kd files.
+
+        '''
+        kd_months = np.empty(
+            (len(months), len(cfg.KD_CHANNELS),
+             region.lat.size, region.lon.size), dtype=np.float32)
+        tiles = []
+        for i, month in enumerate(months):
+            tile = cls(region, month, kd_dir=kd_dir, kd_fpattern=kd_fpattern,
+                       calculate=False)
+            # Swap the tile's Kd for a view into the batch so only one copy
+            # of each month is kept.
+            kd_months[i] = tile.kd_stack
+            tile.kd_stack = kd_months[i]
+            tiles.append(tile)
+
+        z_thresh = region.calculate_z_thresh(kd_months)
+        for i, tile in enumerate(tiles):
+            tile.z_thresh = z_thresh[i:i + 1]
+        return tiles
+
     def get_kd_data(self):
         '''
         Read in the Kd data and extract ROI. Replace fill value with NaNs.
@@ -150,78 +506,48 @@ class ALANTile:
         kd_roi = kd_data.sel(
             lat=slice(self.max_lat + 1, self.min_lat - 1),
             lon=slice(self.min_lon - 1, self.max_lon + 1))
-
-        kd_roi = kd_roi.where(kd_roi != cfg.KD_FILLVAL)
+        kd_roi = kd_roi[list(cfg.KD_CHANNELS)].load()
+
+        # Replace fill values in place rather than using Dataset.where, which
+        # builds a new array per channel.
+        for channel in kd_roi.data_vars:
+            channel_data = kd_roi[channel].values
+            fill_mask = channel_data == cfg.KD_FILLVAL
+            channel_data[fill_mask] = np.nan
         return kd_roi
 
     def regrid_kd(self):
-        '''Put the Kd data onto target grid. Returns Dict of numpy arrays.'''
-        kd_regridded = {}
-        mx, my = np.meshgrid(
-            self.lon.data, self.lat.data, indexing='ij')
-        for channel in ['kd_blue', 'kd_red', 'kd_green']:
-            regridded = fill_and_regrid(self.kd_data[channel][0], mx, my)
-            kd_regridded[channel] = regridded
-        return kd_regridded
-
-    def apply_landmask(self, in_arr):
         '''
-        Apply the landmask to the input array and return masked array.
-        The dimensions of input need to match landmask data.
-
-        Args:
-
-        in_arr (numpy.array): Array to be masked.
+        Put the Kd data onto target grid. Returns numpy array (channel, lat,
+        lon) with channels in the order of cfg.KD_CHANNELS.
 
         '''
-        land_mask = ~(self.landmask_data.landmask.compute() == 255).data
-        masked_arr = in_arr.copy()
-        masked_arr[land_mask] = np.nan
-        return masked_arr
+        # All channels (and months) share the Kd grid so the target indices
+        # come from the region cache.
+        weights = self.region.get_regrid_weights(self.kd_data)
+        kd_stack = np.empty(
+            (len(cfg.KD_CHANNELS), self.lat.size, self.lon.size),
+            dtype=np.float32)
+        for i, channel in enumerate(cfg.KD_CHANNELS):
+            kd = self.kd_data[channel][0].values
+            kd_stack[i] = fill_and_regrid(
+                kd, weights, self.region.get_kd_fill_indices(kd))
+        return kd_stack
 
     def calculate_z_thresh(self):
         '''
         Calculate the critical depth using Falchi and Kd inputs.
-        Apply landmask to result.
-
-        '''
-        # Calculate the above water values of irradiance in the blue, green,
-        # red. Falchi units are in mCd/m2. Irradiance is in uW/m2.
-        # Calculation with offset added (7/3/21). This corroborated by
-        # working with the Tamir data in Eilat.
-        sfce_irr_blue_uW_m2 = cfg.M_BLUE * self.falchi_masked + cfg.C_BLUE
-        sfce_irr_green_uW_m2 = cfg.M_GREEN * self.falchi_masked + cfg.C_GREEN
-        sfce_irr_red_uW_m2 = cfg.M_RED * self.falchi_masked + cfg.C_RED
-        sfce_irr_total_uW_m2 = \
-            sfce_irr_blue_uW_m2 + sfce_irr_green_uW_m2 + sfce_irr_red_uW_m2
-
-        R_blue = sfce_irr_blue_uW_m2 / sfce_irr_total_uW_m2
-        R_green = sfce_irr_green_uW_m2 / sfce_irr_total_uW_m2
-        R_red = sfce_irr_red_uW_m2 / sfce_irr_total_uW_m2
-
-        Kd_log_expression = \
-            R_blue.data * np.exp(-1.0 * self.kd_regridded['kd_blue']) + \
-            R_green.data * np.exp(-1.0 * self.kd_regridded['kd_green']) + \
-            R_red.data * np.exp(-1.0 * self.kd_regridded['kd_red'])
-
-        Kd_total = np.where(
-            np.logical_and(Kd_log_expression > 0.,
-                           ~np.isnan(Kd_log_expression)),
-            -1.0 * np.log(Kd_log_expression),
-            np.nan
-        )
-        Kd_total = np.where(Kd_total > 0.0, Kd_total, np.nan)
-
-        z_thresh = (-1.0 / Kd_total) * np.log(
-            cfg.THRESH_IRR_TOTAL_UW_M2 / sfce_irr_total_uW_m2)
+        Apply landmask to result. Returns array with shape (1, lat, lon),
+        i.e. with a leading time axis ready for the output dataset.
 
-        z_thresh = self.apply_landmask(z_thresh)
-        return z_thresh
+        '''
+        return self.region.calculate_z_thresh(self.kd_stack[np.newaxis])
 
     def make_z_thresh_dataset(self):
         '''
         Put the z_thresh numpy array in an xarray dataset.
-        Add attributes to the variables.
+        Add attributes to the variables. To avoid a copy, the NaNs in
+        z_thresh are replaced in place with cfg.VALUE_TO_REPLACE_NANS.
 
         '''
         # Force all time values to be 2019-{Month}-01
@@ -229,26 +555,20 @@ class ALANTile:
             datetime(cfg.YEAR_VALUE_TO_COERCE_DATES, int(self.month), 1)
             - datetime(1970, 1, 1)).days]
 
-        # Edit the global attributes here
-        edited_attrs = copy.deepcopy(attrs.global_attributes)
-        edited_attrs['title'] = edited_attrs['title'].replace(
-            'REGION_PLACEHOLDER', self.region_name)
-        edited_attrs['extents'] = edited_attrs['extents'].replace(
-            'SPATIAL_PLACEHOLDER',
-            f'Latitude: [{self.min_lat},{self.max_lat}] '
-            f'Longitude: [{self.min_lon},{self.max_lon}]')
-        edited_attrs['abstract'] = edited_attrs['abstract'].replace(
-            'SPATIAL_PLACEHOLDER',
-            f'Latitude: [{self.min_lat},{self.max_lat}] '
-            f'Longitude: [{self.min_lon},{self.max_lon}]')
-        edited_attrs['creation_date'] = edited_attrs['creation_date'].replace(
-            'CREATION_PLACEHOLDER', f'{datetime.now().strftime("%d/%m/%Y")}')
+        # Edit the global attributes here. The region placeholders are
+        # already filled in by the region.
+        edited_attrs = {
+            **self.region.global_attributes,
+            'creation_date': attrs.global_attributes['creation_date'].replace(
+                'CREATION_PLACEHOLDER',
+                f'{datetime.now().strftime("%d/%m/%Y")}'),
+        }
 
         z_thresh_ds = xr.Dataset(
             data_vars={
                 'z_thresh': (
                     ['time', 'lat', 'lon'],
-                    np.expand_dims(self.z_thresh, axis=0),
+                    self.z_thresh,
                     # Set the z_thresh attributes here.
                     attrs.z_thresh_attributes
                 )
@@ -265,8 +585,8 @@ class ALANTile:
             attrs=edited_attrs,
         )
         # Replace NaNs with a value
-        z_thresh_ds['z_thresh'].data = z_thresh_ds['z_thresh'].fillna(
-            cfg.VALUE_TO_REPLACE_NANS)
+        np.nan_to_num(z_thresh_ds['z_thresh'].data, copy=False,
+                      nan=cfg.VALUE_TO_REPLACE_NANS)
 
         # Add additional lat attributes here.
         z_thresh_ds['lat'].attrs['valid_min'] = -90.0
@@ -313,12 +633,66 @@ class ALANTile:
         fname = output_fname or self.make_output_fname(region_name)
         z_thresh_ds = self.make_z_thresh_dataset()
         output_path = Path(output_dir) / fname
+        # Blosc/zstd with bitshuffle is much faster than zlib at a similar
+        # ratio. Readers need the HDF5 Blosc filter (e.g. hdf5plugin).
+        # Chunks match the Zarr output rather than h5py's much smaller
+        # default, which adds per-chunk overhead and lowers the ratio.
+        _, n_lat, n_lon = z_thresh_ds['z_thresh'].shape
         encoding = {
-            'z_thresh': {'zlib': True, 'complevel': 5},
+            'z_thresh': {
+                **hdf5plugin.Blosc(
+                    cname='zstd', clevel=3,
+                    shuffle=hdf5plugin.Blosc.BITSHUFFLE),
+                'chunksizes': (1, min(n_lat, 512), min(n_lon, 512))},
             'lat': {'_FillValue': None},
             'lon': {'_FillValue': None}
         }
-        z_thresh_ds.to_netcdf(output_path, encoding=encoding)
+        z_thresh_ds.to_netcdf(
+            output_path, engine='h5netcdf', encoding=encoding)
+        return z_thresh_ds
+
+    def make_output_store_name(self, region_name=None):
+        '''
+        Create string for the output Zarr store name. The store holds all
+        months for the region, so unlike make_output_fname there is no month.
+
+        Args:
+
+        region_name (str): Optionally add a region name to end of name.
+
+        '''
+        if region_name:
+            region_str = f'_{region_name}'
+        else:
+            region_str = ''
+        return f'In-water_clear-sky_ALAN_Zc_' \
+               f'{self.min_lat}S_{self.max_lat}N_' \
+               f'{self.min_lon}W_{self.max_lon}E{region_str}.zarr'
+
+    def save_z_thresh_to_zarr(
+            self, output_dir='./', output_store=None, region_name=None,
+            append=False):
+        '''
+        Save the critical depth output to a Zarr store. By default the store
+        is created, overwriting any existing store; with append the month is
+        added along the time dimension of an existing store (e.g. written by
+        an earlier month of the same region in this run).
+
+        Args:
+
+        output_dir (str):
+            Optionally provide path to output dir (default current dir).
+        output_store (str): Optionally override the default store name.
+        region_name (str):
+            If using default store name can optionally add the region name
+            to end of store name.
+        append (bool): Append to an existing store rather than overwrite.
+
+        '''
+        store_name = output_store or self.make_output_store_name(region_name)
+        z_thresh_ds = self.make_z_thresh_dataset()
+        write_z_thresh_to_zarr(
+            z_thresh_ds, Path(output_dir) / store_name, append=append)
         return z_thresh_ds
 
     def display_z_thresh(self):
@@ -2,6 +2,8 @@
 # Constants:
 FALCHI_MASK_THRESHOLD = 0.03
 KD_FILLVAL = 9.969209968386869e+36
+# Order of the Kd channels in the regridded (channel, lat, lon) stack.
+KD_CHANNELS = ('kd_blue', 'kd_green', 'kd_red')
 
 M_BLUE = 4.530851872
 M_GREEN = 7.272195079